@@ -32,7 +32,13 @@ Many of the design decisions were informed by the need to facilitate integration
 import csv
 import pandas as pd
 import numpy as np
-import os, subprocess
+import os, subprocess, hashlib, pickle, io
+
+try:
+    from numba import njit
+except ImportError: #numba is optional; without it ced_kernel runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 
 BaseDir = os.getcwd()
@@ -42,6 +48,9 @@ InputDir = os.path.join(KDEPDir, 'InputFiles')
 
 activities = { 1: "Sleep", 2: "Sitting", 3:"LightExercise",4:"HeavyExercise",5:"StandardWorker",6:"HeavyWorker",7:"MemberOfPublicFullDay"}
 subjects = { 1: "AdultMale", 2: "AdultFemale", 3:"15YearOldMale",4:"15YearOldFemale",5:"10YearOld",6:"5YearOld",7:"1YearOld",8:"3MonthOld"}
+#Subject and activity names KDEP writes at the end of kdep.csv
+kdep_subjects = { 1: "Adult Male", 2: "Adult Female", 3:"15 year-old Male",4:"15 year-old Female",5:"10 year-old",6:"5 year-old",7:"1 year-old",8:"3 month-old"}
+kdep_activities = { 1: "Sleeping", 2: "Sitting", 3:"Light Exercise",4:"Heavy Exercise",5:"Standard Work",6:"Heavy Work",7:"Member of the Public"}
 ages = { '1': 9125, '2': 9125, '3':5475, '4':5475, '5':3650, '6':1825 ,'7':365, '8':100}
 
 #Remainder tissue masses from ICRP Publication 71 Table 11, Page 28. Dictionary key is subject.
@@ -49,232 +58,300 @@ remainder_tissues_dict = {1:[28000.,1400.,640.,310.,100.,180.,20.,80.,14.,15.5],
                           3:[22000.,1410.,516.,248.,64.9,123.,28.4,80.,10.5,12.1], 4:[22000.,1410.,516.,248.,64.9,123.,28.4,80.,10.5,12.1],\
                           5:[11000.,1360.,286.,173.,30.,77.4,31.4,4.2,7.2,7.1],6:[5000.,1260.,169.,116.,23.6,48.3,29.6,2.7,5.3,4.3], \
                           7:[2500.,884.,84.9,62.9,10.3,25.5,22.9,1.5,3.5,2.2], 8:[760.,352.,32.6,22.9,2.8,9.1,11.3,3.9,5.8,1.3]}
+
+#Remainder tissue masses as fractions of the total remainder mass. Dictionary key is subject.
+remainder_fractions_dict = {k: np.asarray(v,dtype=np.float64)/sum(v) for k,v in remainder_tissues_dict.items()}
     
 main_tissues_wt = np.array([0.2,0.12,0.12,0.12,0.12,0.05,0.05,0.05,0.05,0.05,0.01,0.01])
 
+@njit(cache=True)
+def ced_kernel(S, rem_frac, main_wt, col_idx):
+    """Calculate committed effective doses from organ doses S, with one row per AMAD.
+
+    col_idx holds the columns of S for ULI-Wall, LLI-Wall, Ovaries, Testes, R-Marrow, Lungs, St-Wall,
+    UB-Wall, Breasts, Liver, Thymus, Thyroid, Skin, B-Surface, followed by the ten remainder tissues.
+    Returns (e50, main_tissues, remainder_tissues, remainder_eq), with one row per AMAD.
+    """
+    n = S.shape[0]
+    e50 = np.empty(n)
+    main_tissues = np.empty((n,12))
+    remainder_tissues = np.empty((n,10))
+    remainder_eq = np.empty(n)
+
+    for j in range(n):
+        row = S[j]
+        #Main Tissues are Gonads, Bone Marrow, Colon, Lung, Stomach, Bladder, Breast, Liver, Oesophagus, Thyroid, Skin, and Bone Surface
+        main_tissues[j,0] = max(row[col_idx[2]],row[col_idx[3]])
+        main_tissues[j,1] = row[col_idx[4]]
+        main_tissues[j,2] = row[col_idx[0]]*0.57+row[col_idx[1]]*0.43
+        main_tissues[j,3:] = row[col_idx[5:14]]
+        main_tissues_eff = (main_tissues[j]*main_wt).sum()
+
+        #Remainder Tissues are Muscle, Brain, Small Intestine, Kidneys, Pancreas, Spleen, Thymus, Uterus, Adrenals, and Extrathoracic Airways
+        remainder_tissues[j] = row[col_idx[14:24]]
+        i_max_remainder = np.argmax(remainder_tissues[j])
+        max_remainder = remainder_tissues[j,i_max_remainder]
+
+        if max_remainder<main_tissues[j].max():
+            #Remainder formulation: standard
+            remainder_eff = (rem_frac*remainder_tissues[j]).sum()*0.05
+        else:
+            #Remainder formulation: split
+            max_remainder_eff = max_remainder*0.025
+            remainder_mass_fractions = rem_frac.copy()
+            remainder_mass_fractions[i_max_remainder] = 0
+            remainder_eff = (remainder_mass_fractions*remainder_tissues[j]).sum()*0.025
+            remainder_eff = remainder_eff+max_remainder_eff
+
+        remainder_eq[j] = remainder_eff/0.05
+        e50[j] = main_tissues_eff+remainder_eff
+
+    return e50, main_tissues, remainder_tissues, remainder_eq
+
+def read_input_csv(filename):
+    """Read one of the input CSV files into a DataFrame of text values.
+
+    Only lines starting with ! are comments, so a ! later in a line is kept as data. Empty fields stay
+    empty strings rather than NaN, so values are written back to the KDEP input exactly as given.
+    """
+    with open(filename) as csvfile:
+        lines = [line for line in csvfile if not line.startswith('!')]
+    return pd.read_csv(io.StringIO(''.join(lines)),dtype=str,keep_default_na=False)
+
+#Bump whenever the value returned by read_hdb changes, so old HDB caches are not reused
+HDB_CACHE_VERSION = 1
+
+def read_hdb(filename):
+    """Read an HDB table of doses per unit deposition.
+
+    Returns the (Nuclide, Age, Class) key of each row, the rows as a float64 array, and the names of their columns.
+    """
+    with open(filename) as hdbfile:
+        hdbfile.readline()
+        names = hdbfile.readline().split()
+        ncols = len(hdbfile.readline().split())
+    #The first data row shares a line with the column headers, so it is dropped along with them
+    names = names[3:ncols]
+    keys = np.loadtxt(filename,skiprows=2,usecols=(0,1,2),dtype=str)
+    arr = np.loadtxt(filename,skiprows=2,usecols=range(3,ncols),dtype=np.float64)
+    return [(nuc,int(age),cls) for nuc,age,cls in keys.tolist()], arr, names
+
 #Read Input Files
 
 print("Reading Nuclides.csv")
-nuclides, solubilities,sizes,distributions =[],[],[],[]
-NuclideLines,SizesLines = [],[]
-
-with open("Nuclides.csv") as csvfile:
-    lines = csv.reader(csvfile,delimiter=',')
-    for line in lines:
-        if (line[0][0]=='!'): #Skip comment lines
-            pass
-        else:
-            NuclideLines= NuclideLines + [line]
-            nuclides = nuclides+[line[0].strip()]
-            solubilities = solubilities + [line[1].strip()]
-
-#Remove column headers
-nuclides = nuclides[1:]
-solubilities = solubilities[1:]
+#Lines starting with ! are comments; the first remaining line holds the column headers
+dfNuclides = read_input_csv(os.path.join(BaseDir,"Nuclides.csv"))
+nuclides = dfNuclides.iloc[:,0].str.strip().tolist()
+solubilities = dfNuclides.iloc[:,1].str.strip().tolist()
 
 print("Reading SizesInp.csv")
-with open("SizesInp.csv") as csvfile:
-    lines = csv.reader(csvfile,delimiter=',')
-    for line in lines:
-        SizesLines= SizesLines + [line]
-        if (line[0][0]=='!'): #Skip comment lines
-            pass
-        else:
-            distributions = distributions + [line[0]]
-            sizes = sizes + [line[1]]
-
-#Remove column headers
-sizes = sizes[1:]
-distributions = distributions[1:]
-
-monodispursed, nose_breather,subject,activity,rho,shape_factor,wind_speed,Atm_Pressure,Chronic,ICRP130,age = ([] for i in range(11))
-CaseParamsLines,CaseParamsHeader = [],[]
+#SizesInp.csv is passed through to KDEP unchanged, comments included
+with open(os.path.join(BaseDir,"SizesInp.csv")) as csvfile:
+    SizesLines = list(csv.reader(csvfile,delimiter=','))
+dfSizes = read_input_csv(os.path.join(BaseDir,"SizesInp.csv"))
+distributions = dfSizes.iloc[:,0].tolist()
+sizes = dfSizes.iloc[:,1].tolist()
 
 print("Reading CaseParams.csv")
-with open("CaseParams.csv") as csvfile:
-    lines = csv.reader(csvfile,delimiter=',')
-    for line in lines:
-        if (line[0][0]=='!'): #Skip comment lines
-            CaseParamsHeader = CaseParamsHeader+[line]
-            pass
-        else:
-            CaseParamsLines = CaseParamsLines + [line]
-
-for line in CaseParamsLines[1:]:
-    monodispursed = monodispursed + [line[0]]
-    nose_breather = nose_breather + [line[1]]
-    subject = subject + [int(line[2])]
-    activity = activity + [int(line[3])]
-    rho = rho + [line[4]]
-    shape_factor = shape_factor + [line[5]]
-    wind_speed = wind_speed + [line[6]]
-    Atm_Pressure = Atm_Pressure + [line[7]]
-    Chronic = Chronic + [line[8]]
-    ICRP130 = ICRP130 + [line[9]]
-    age = age + [ages[line[2]]]
+#The comment lines are kept to be written at the top of each KDEP input file
+with open(os.path.join(BaseDir,"CaseParams.csv")) as csvfile:
+    CaseParamsHeader = [line for line in csv.reader(csvfile,delimiter=',') if line and line[0].startswith('!')]
+dfCaseParams = read_input_csv(os.path.join(BaseDir,"CaseParams.csv"))
+CaseParamsLines = dfCaseParams.values.tolist()
+
+monodispursed, nose_breather,subject,activity,rho,shape_factor,wind_speed,Atm_Pressure,Chronic,ICRP130 = \
+    (dfCaseParams.iloc[:,i].tolist() for i in range(10))
+age = [ages[s] for s in subject]
+subject = [int(s) for s in subject]
+activity = [int(a) for a in activity]
 
 #ReadHDB
-print("Reading HDB Tables")
-os.chdir(DCPAKDir)
-dfET1 = pd.read_table("ET1.HDB", delim_whitespace=True,skiprows=1)
-dfET2 = pd.read_table("ET2.HDB", delim_whitespace=True,skiprows=1)
-
-dfBBEGEL = pd.read_table("BBE-GEL.HDB", delim_whitespace=True,skiprows=1)
-dfBBESEQ = pd.read_table("BBE-SEQ.HDB", delim_whitespace=True,skiprows=1)
-dfBBESOL = pd.read_table("BBE-SOL.HDB", delim_whitespace=True,skiprows=1)
-
-dfBBISEQ = pd.read_table("BBI-SEQ.HDB", delim_whitespace=True,skiprows=1)
-dfBBISOL = pd.read_table("BBI-SOL.HDB", delim_whitespace=True,skiprows=1)
-dfBBIGEL = pd.read_table("BBI-GEL.HDB", delim_whitespace=True,skiprows=1)
-
-dfAI = pd.read_table("AI.HDB", delim_whitespace=True,skiprows=1)
-
-os.chdir(BaseDir)
+HDBFiles = ["ET1.HDB","ET2.HDB","BBE-GEL.HDB","BBE-SEQ.HDB","BBE-SOL.HDB","BBI-SEQ.HDB","BBI-SOL.HDB","BBI-GEL.HDB","AI.HDB"]
+HDBPaths = [os.path.join(DCPAKDir,filename) for filename in HDBFiles]
+
+#Parsed tables are pickled so later runs can skip parsing. The cache records the format version and the
+#path, size and modification time of each HDB file, and is only used when all of them match exactly.
+HDBCacheFile = os.path.join(BaseDir,'hdb_cache.pkl')
+HDBStamp = (HDB_CACHE_VERSION,[(path,os.path.getsize(path),os.path.getmtime(path)) for path in HDBPaths])
+HDBTables = None
+if os.path.exists(HDBCacheFile):
+    #An empty or truncated cache (e.g. from an interrupted run) is ignored and the tables are parsed again
+    try:
+        with open(HDBCacheFile,'rb') as f:
+            if (pickle.load(f)==HDBStamp):
+                HDBTables = pickle.load(f)
+                print("Read cached HDB Tables")
+    except (EOFError,pickle.UnpicklingError,AttributeError,ValueError,IndexError):
+        HDBTables = None
+if HDBTables is None:
+    print("Reading HDB Tables")
+    HDBTables = [read_hdb(path) for path in HDBPaths]
+    #The cache is written to a temporary file and moved into place, so it is never left half written
+    with open(HDBCacheFile+'.tmp','wb') as f:
+        pickle.dump(HDBStamp,f,protocol=5)
+        pickle.dump(HDBTables,f,protocol=5)
+    os.replace(HDBCacheFile+'.tmp',HDBCacheFile)
+
+#Rows are indexed by position through COL, so every table must have the same columns as ET1.HDB
+HDBColumns = HDBTables[0][2]
+for filename,(keys,arr,names) in zip(HDBFiles,HDBTables):
+    if (names!=HDBColumns):
+        print("Error: columns of "+filename+" do not match ET1.HDB")
+        exit()
+
+#Each table becomes a dict mapping (Nuclide, Age, Class) to a row of doses per unit deposition
+(ET1_lut,ET2_lut,BBEGEL_lut,BBESEQ_lut,BBESOL_lut,BBISEQ_lut,BBISOL_lut,BBIGEL_lut,AI_lut) = \
+    [dict(zip(keys,arr)) for keys,arr,names in HDBTables]
+
+#Column positions within an HDB row (f1 and organ doses)
+COL = {name: i for i, name in enumerate(HDBColumns)}
+
+#Columns passed to ced_kernel. Thymus is listed twice: it stands in for the oesophagus among the
+#main tissues and is also a remainder tissue.
+CED_COLS = np.array([COL[name] for name in ("ULI-Wall","LLI-Wall","Ovaries","Testes","R-Marrow","Lungs","St-Wall","UB-Wall", \
+                                            "Breasts","Liver","Thymus","Thyroid","Skin","B-Surface", \
+                                            "Muscle","Brain","SI-Wall","Kidneys","Pancreas","Spleen","Thymus","Uterus", \
+                                            "Adrenals","ET-Region")])
 
 
 #Call KDEP
-os.chdir(InputDir)
-print(os.getcwd())
-
 print("Writing Sizes.csv")
-#with open('Sizes.csv', 'wb') as f: #Python 2 version
-with open('Sizes.csv', 'w+',newline='') as f: #Python3 version
+#with open(os.path.join(InputDir,'Sizes.csv'), 'wb') as f: #Python 2 version
+with open(os.path.join(InputDir,'Sizes.csv'), 'w+',newline='') as f: #Python3 version
     writer = csv.writer(f)
     writer.writerows(SizesLines)
 
+#KDEP output depends only on its input files and the executable, so parsed results are cached by a
+#hash of their contents, in memory and under KDEP/cache. The cache files are binary .npy arrays of
+#float64, so repeated cases skip parsing kdep.csv. Delete that directory to force KDEP to re-run.
+KDEPCacheDir = os.path.join(KDEPDir, 'cache')
+os.makedirs(KDEPCacheDir, exist_ok=True)
+kdep_cache = {}
+KDEPExe = os.path.join(KDEPDir,'kdep.exe')
+KDEPOutput = os.path.join(KDEPDir,'kdep.csv')
+with open(KDEPExe,'rb') as f:
+    kdep_exe_hash = hashlib.blake2b(f.read()).hexdigest()
+
+#The HDB rows for the nuclide list depend only on age, so cases of the same age share them
+H3_cache = {}
+
 for subject, activity,age,CaseParamsLine in zip(subject,activity,age,CaseParamsLines):
-    print("Writing input.csv")
     print(subject,activity,age)
-    os.chdir(InputDir)
     Lines =[]
     Lines = CaseParamsHeader+[CaseParamsLine]
     print(CaseParamsLine)
-#    with open('input.csv', 'wb') as f: #Python 2 Version
-    with open('input.csv', 'w',newline='') as f: #Python 3 Version
-    #    f.write(CaseParamsLines)
-        writer = csv.writer(f)
-        writer.writerows(Lines)
-
-
-    os.chdir(KDEPDir)
-    print(os.getcwd())
-
-    print("Running KDEP")
-    subprocess.call('kdep.exe')
-    print("KDEP Finished")
-
-
-    AMADs, AMTDs,ET1s,ET2s,Bs,bbs,AIs,Totals,FsBs,Fsbbs,BBi_GELs, BBi_SOLs, BBi_SEQs, bbe_GELs, bbe_SOLs, bbe_SEQs =([] for i in range(16))
-    KDEPLines = []
-    print("Reading kdep.csv")
-    with open("kdep.csv") as csvfile:
-        lines = csv.reader(csvfile,delimiter=',')
-        for line in lines:
-            KDEPLines = KDEPLines + [line]
-
-    n = len(KDEPLines)-4
-    for line in KDEPLines[1:n]:
-            AMADs = AMADs+[float(line[0])]
-            AMTDs = AMTDs + [float(line[1])]
-            ET1s = ET1s+[float(line[2])]
-            ET2s = ET2s+[float(line[3])]
-            Bs = Bs+[float(line[4])]
-            bbs = bbs+[float(line[5])]
-            AIs = AIs+[float(line[6])]
-            Totals = Totals+[float(line[7])]
-            FsBs = FsBs+[float(line[8])]
-            Fsbbs = Fsbbs+[float(line[9])]
-            BBi_GELs = BBi_GELs + [float(line[4])*(0.993-float(line[8]))]
-            BBi_SOLs = BBi_SOLs + [float(line[4])*(float(line[8]))]
-            BBi_SEQs = BBi_SEQs + [float(line[4])*(0.007)]
-            bbe_GELs = bbe_GELs + [float(line[5])*(0.993-float(line[9]))]
-            bbe_SOLs = bbe_SOLs + [float(line[5])*(float(line[9]))]
-            bbe_SEQs = bbe_SEQs + [float(line[5])*(0.007)]
-
-
-    for nuclide,solubility in zip(nuclides,solubilities):
-        #CalcEffDose
-        #find the right radionuclide
-        print("Calculating Effective Dose")
-        print(nuclide,solubility)
-        queryline = "Nuclide==\""+nuclide+"\" and Age=="+str(age)+ " and Class==\""+solubility+"\""
-
-        dfET1Eq = dfET1.query(queryline).iloc[:,3:]
-
-        if (age==9125 and len(dfET1Eq)==0):
-            print("Age not found, trying 7300")
-            queryline = "Nuclide==\""+nuclide+"\" and Age=="+str(7300)+ " and Class==\""+solubility+"\""
-            dfET1Eq = dfET1.query(queryline).iloc[:,3:]
-        if (len(dfET1Eq)==0):
-            print("Error: entry not found. Queryline = "+queryline)
+    kdep_key = hashlib.blake2b(repr((kdep_exe_hash,Lines,SizesLines)).encode()).hexdigest()
+    kdep_cachefile = os.path.join(KDEPCacheDir, kdep_key+'.npy')
+
+    K = None
+    if kdep_key in kdep_cache:
+        print("Using cached KDEP results")
+        K = kdep_cache[kdep_key]
+    elif os.path.exists(kdep_cachefile):
+        #A truncated or corrupt cache file is treated as a miss and KDEP is run again
+        try:
+            K = np.load(kdep_cachefile)
+            print("Read cached KDEP results")
+        except (EOFError,ValueError,OSError,pickle.UnpicklingError):
+            K = None
+    if K is None:
+        print("Writing input.csv")
+    #    with open(os.path.join(InputDir,'input.csv'), 'wb') as f: #Python 2 Version
+        with open(os.path.join(InputDir,'input.csv'), 'w',newline='') as f: #Python 3 Version
+        #    f.write(CaseParamsLines)
+            writer = csv.writer(f)
+            writer.writerows(Lines)
+
+
+        #KDEP stops without writing kdep.csv when it fails, so remove the previous case's output first
+        if os.path.exists(KDEPOutput):
+            os.remove(KDEPOutput)
+
+        print("Running KDEP")
+        returncode = subprocess.call([KDEPExe],cwd=KDEPDir)
+        if (returncode!=0 or not os.path.exists(KDEPOutput)):
+            print("Error: KDEP failed for case "+str(CaseParamsLine))
+            exit()
+        print("KDEP Finished")
+
+
+        print("Reading kdep.csv")
+        with open(KDEPOutput) as csvfile:
+            KDEPLines = csvfile.readlines()
+
+        #The four trailing lines describe the case; make sure it is the one just run before caching
+        if (KDEPLines[-3].strip()!=kdep_subjects[subject] or KDEPLines[-2].strip()!=kdep_activities[activity]):
+            print("Error: kdep.csv does not match case "+str(CaseParamsLine))
             exit()
 
-        f = float(dfET1Eq.loc[:,"f"])
-
-        dfET2Eq = dfET2.query(queryline).iloc[:,4:]
-        dfBBEGELEq = dfBBEGEL.query(queryline).iloc[:,4:]
-        dfBBESEQEq = dfBBESEQ.query(queryline).iloc[:,4:]
-        dfBBESOLEq = dfBBESOL.query(queryline).iloc[:,4:]
-        dfBBISEQEq = dfBBISEQ.query(queryline).iloc[:,4:]
-        dfBBISOLEq = dfBBISOL.query(queryline).iloc[:,4:]
-        dfBBIGELEq = dfBBIGEL.query(queryline).iloc[:,4:]
-        dfAIEq = dfAI.query(queryline).iloc[:,4:]
-
-        CED = []
-        data = []
-        Columns = ["AMAD","AMTD","Nuclide","Subject","Activity","Solubility","f1","CED","Gonads","R-Marrow","Colon","Lungs","Stomach","Bladder", \
-                   "Breasts","Liver","Oesophagus","Thyroid","Skin","Bone Surface","Muscle","Brain","SI-Wall","Kidneys","Pancreas","Spleen","Thymus", \
-                   "Uterus","Adrenals","Extrathoracic Tissues","Remainder"]
-
-
-        #Take sum weighted by lung depostion
-        for AMAD,AMTD,ET1,ET2,bbe_GEL,bbe_SEQ,bbe_SOL,BBi_SEQ,BBi_SOL,BBi_GEL,AI in zip(AMADs,AMTDs,ET1s,ET2s,bbe_GELs,bbe_SEQs,bbe_SOLs,BBi_SEQs,BBi_SOLs,BBi_GELs,AIs):
-             
-            dfSumEq = dfET1Eq*ET1+dfET2Eq*ET2+dfBBEGELEq*bbe_GEL+dfBBESEQEq*bbe_SEQ+dfBBESOLEq*bbe_SOL+dfBBISEQEq*BBi_SEQ+dfBBISOLEq*BBi_SOL+dfBBIGELEq*BBi_GEL+dfAIEq*AI
-
-            #Add up tissues to determine CED
-            colon = float(dfSumEq.loc[:,"ULI-Wall"]*0.57+dfSumEq.loc[:,"LLI-Wall"]*0.43)
-            Ovaries = float(dfSumEq.loc[:,"Ovaries"])
-            Testes = float(dfSumEq.loc[:,"Testes"])
-            gonads = max(Ovaries,Testes)
-
-            #Main Tissues are Gonads, Bone Marrow, Colon, Lung, Stomach, Bladder, Breast, Liver, Oesophagus, Thyroid, Skin, and Bone Surface
-            main_tissues = np.array([gonads,float(dfSumEq.loc[:,"R-Marrow"]),colon,float(dfSumEq.loc[:,"Lungs"]),float(dfSumEq.loc[:,"St-Wall"]), \
-                                     float(dfSumEq.loc[:,"UB-Wall"]),float(dfSumEq.loc[:,"Breasts"]),float(dfSumEq.loc[:,"Liver"]), \
-                                     float(dfSumEq.loc[:,"Thymus"]),float(dfSumEq.loc[:,"Thyroid"]),float(dfSumEq.loc[:,"Skin"]),\
-                                     float(dfSumEq.loc[:,"B-Surface"])])
-            main_tissues_eff = np.dot(main_tissues,main_tissues_wt)
-
-            #Remainder Tissues are Muscle, Brain, Small Intestine, Kidneys, Pancreas, Spleen, Thymus, Uterus, Adrenals, and Extrathoracic Airways
-            remainder_tissues = np.array([float(dfSumEq.loc[:,"Muscle"]),float(dfSumEq.loc[:,"Brain"]),float(dfSumEq.loc[:,"SI-Wall"]),float(dfSumEq.loc[:,"Kidneys"]), \
-                                          float(dfSumEq.loc[:,"Pancreas"]),float(dfSumEq.loc[:,"Spleen"]),float(dfSumEq.loc[:,"Thymus"]),float(dfSumEq.loc[:,"Uterus"]),\
-                                          float(dfSumEq.loc[:,"Adrenals"]),float(dfSumEq.loc[:,"ET-Region"])])
-            remainder_masses = np.array(remainder_tissues_dict[subject])
-            remainder_mass = sum(remainder_masses)
-
-            if max(remainder_tissues)<max(main_tissues):
-                print("Remainder formulation: standard")
-                remainder_tissues = remainder_tissues
-                remainder_mass_fractions = remainder_masses/remainder_mass
-                remainder_eff = np.dot(remainder_mass_fractions,remainder_tissues)*0.05
-
-            else:
-                print("Remainder formulation: split")
-                i_max_remainder = np.argmax(remainder_tissues)
-                max_remainder_eff = max(remainder_tissues)*0.025
-                remainder_masses[i_max_remainder] = 0
-                remainder_mass_fractions = remainder_masses/remainder_mass
-                remainder_eff = np.dot(remainder_mass_fractions,remainder_tissues)*0.025
-                remainder_eff = remainder_eff+max_remainder_eff
-            person = subjects[subject]
-            act = activities[activity]
-            remainder_eq = remainder_eff/0.05
-            e50 = [main_tissues_eff+remainder_eff]
-            output = np.concatenate(([AMAD],[AMTD],[nuclide],[person],[act],[solubility],[f],e50,main_tissues,remainder_tissues,[remainder_eq]))
-            data = data + [list(output)]
-
-
-        Filename = str(nuclide)+'-'+person+'-'+act+'-'+str(solubility)+'.csv'
-        results = pd.DataFrame(data,columns=Columns)
-        filepath = os.path.join(BaseDir, 'OutputFiles',Filename)
-        results.to_csv(filepath)
\ No newline at end of file
+        #Skip the column headers and the four trailing lines describing the case
+        n = len(KDEPLines)-4
+        K = np.loadtxt(KDEPLines[1:n],delimiter=',',ndmin=2)
+        #Saved under a temporary name and moved into place, so the cache never holds a half written file
+        np.save(os.path.join(KDEPCacheDir, kdep_key+'.tmp.npy'), K)
+        os.replace(os.path.join(KDEPCacheDir, kdep_key+'.tmp.npy'), kdep_cachefile)
+    kdep_cache[kdep_key] = K
+
+    AMADs,AMTDs,ET1s,ET2s,Bs,bbs,AIs,Totals,FsBs,Fsbbs = K[:,:10].T
+    BBi_GELs = Bs*(0.993-FsBs)
+    BBi_SOLs = Bs*FsBs
+    BBi_SEQs = Bs*0.007
+    bbe_GELs = bbs*(0.993-Fsbbs)
+    bbe_SOLs = bbs*Fsbbs
+    bbe_SEQs = bbs*0.007
+
+    #Deposition in each region for every AMAD, one column per HDB table
+    W = np.column_stack([ET1s,ET2s,bbe_GELs,bbe_SEQs,bbe_SOLs,BBi_SEQs,BBi_SOLs,BBi_GELs,AIs])
+
+    person = subjects[subject]
+    act = activities[activity]
+
+    #Rows for every nuclide are collected and written to a single file for this subject and activity
+    data = []
+    Columns = ["AMAD","AMTD","Nuclide","Subject","Activity","Solubility","f1","CED","Gonads","R-Marrow","Colon","Lungs","Stomach","Bladder", \
+               "Breasts","Liver","Oesophagus","Thyroid","Skin","Bone Surface","Muscle","Brain","SI-Wall","Kidneys","Pancreas","Spleen","Thymus", \
+               "Uterus","Adrenals","Extrathoracic Tissues","Remainder"]
+
+    #CalcEffDose
+    if age not in H3_cache:
+        #find the right radionuclides
+        keys = []
+        for nuclide,solubility in zip(nuclides,solubilities):
+            print(nuclide,solubility)
+            key = (nuclide,age,solubility)
+
+            if (age==9125 and key not in ET1_lut):
+                print("Age not found, trying 7300")
+                key = (nuclide,7300,solubility)
+            if (key not in ET1_lut):
+                print("Error: entry not found. Key = "+str(key))
+                exit()
+            keys.append(key)
+
+        #Doses per unit deposition for each nuclide, one row per region in the same order as the columns of W
+        H3_cache[age] = np.stack([np.stack([ET1_lut[key],ET2_lut[key],BBEGEL_lut[key],BBESEQ_lut[key],BBESOL_lut[key], \
+                                            BBISEQ_lut[key],BBISOL_lut[key],BBIGEL_lut[key],AI_lut[key]]) for key in keys])
+
+    print("Calculating Effective Dose")
+    H3 = H3_cache[age]
+    f1s = H3[:,0,COL["f"]]
+
+    #Take sum weighted by lung depostion, all nuclides and AMADs at once
+    S3 = np.einsum('ak,nko->nao',W,H3,optimize=True)
+    n_nuc,n_amad,n_organs = S3.shape
+
+    #Add up tissues to determine CED
+    e50_all,main_tissues_all,remainder_tissues_all,remainder_eq_all = \
+        ced_kernel(S3.reshape(n_nuc*n_amad,n_organs),remainder_fractions_dict[subject],main_tissues_wt,CED_COLS)
+
+    for nuclide,solubility,f,e50s,main_tissues_nuc,remainder_tissues_nuc,remainder_eqs in \
+            zip(nuclides,solubilities,f1s,e50_all.reshape(n_nuc,n_amad),main_tissues_all.reshape(n_nuc,n_amad,-1), \
+                remainder_tissues_all.reshape(n_nuc,n_amad,-1),remainder_eq_all.reshape(n_nuc,n_amad)):
+        for AMAD,AMTD,e50,main_tissues,remainder_tissues,remainder_eq in zip(AMADs,AMTDs,e50s,main_tissues_nuc,remainder_tissues_nuc,remainder_eqs):
+            data.append((AMAD,AMTD,nuclide,person,act,solubility,f,e50,*main_tissues.tolist(),*remainder_tissues.tolist(),remainder_eq))
+
+
+    Filename = person+'-'+act+'.csv'
+    results = pd.DataFrame(data,columns=Columns)
+    filepath = os.path.join(BaseDir, 'OutputFiles',Filename)
+    results.to_csv(filepath)
\ No newline at end of file